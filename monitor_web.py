@@ -1,115 +1,527 @@
+import asyncio
+import errno
+import ipaddress
+import math
 import os
 import platform
-import subprocess
-import time
-import threading
-from datetime import datetime
-from flask import Flask, render_template, jsonify, request
-import requests
+import shutil
 import socket
+import struct
+import threading
+import time
+from array import array
+from asyncio.subprocess import DEVNULL, PIPE
+from datetime import datetime, timezone
+from flask import Flask, Response, render_template, make_response, request
+import aiohttp
+import orjson
 
 # Environment settings
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 TCP_PORTS = os.getenv("TCP_PORTS", "")  # Comma-separated, e.g., "80,443"
 AUTO_REFRESH = int(os.getenv("AUTO_REFRESH", 5))  # seconds
+GRACE_PERIOD = int(os.getenv("GRACE_PERIOD", 0))  # seconds DOWN before alerting
+TARGETS_FILE = "ips.txt"
+RESPONSE_CACHE_TTL = 1.0  # seconds a rendered page / JSON body is reused
 
+# One echo per cycle, capped at a second; GRACE_PERIOD absorbs flapping.
+# -n on Unix stops ping reverse-resolving the address.
 PING_COUNT = 1
-PING_PARAM = "-n" if platform.system().lower() == "windows" else "-c"
+if platform.system().lower() == "windows":
+    PING_ARGS = ["-n", str(PING_COUNT), "-w", "1000"]
+elif platform.system().lower() == "darwin":
+    PING_ARGS = ["-n", "-c", str(PING_COUNT), "-W", "1000"]
+else:
+    PING_ARGS = ["-n", "-c", str(PING_COUNT), "-W", "1"]
+FPING = shutil.which("fping")
+PROBE_LIMIT = 64  # max ping processes in flight
+PROBE_STAGGER = 0.01  # seconds between ping launches, avoids ICMP drops
+ICMP_TIMEOUT = 1.0  # seconds to wait for echo replies each cycle
+TCP_TIMEOUT = 3.0  # seconds to wait for TCP connects each cycle
+CONNECT_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)}
+# Address family -> (protocol, echo request type, echo reply type)
+ICMP_FAMILIES = {
+    socket.AF_INET: (socket.IPPROTO_ICMP, 8, 0),
+    socket.AF_INET6: (socket.IPPROTO_ICMPV6, 128, 129),
+}
+WEBHOOK_TIMEOUT = 5  # seconds per webhook attempt
+WEBHOOK_RETRIES = 2
+WEBHOOK_BACKOFF = 0.3  # seconds, doubled on each retry
+WEBHOOK_RETRY_STATUS = (502, 503, 504)
+DNS_CACHE_TTL = 900  # seconds the webhook host's address is kept in memory
+ALERT_FLUSH_INTERVAL = 5  # seconds between coalesced webhook posts
+ALERT_BATCH_MAX = 50  # messages per webhook post
+ALERT_FLUSH_DEPTH = 20  # queued messages that force an early flush
+PROBE_QUEUE_MAX = 10  # probe cycles buffered for the consumer
+
+# Track host states as parallel arrays, one slot per unique ip;
+# IP_TO_I maps an ip to its slot. NaN latency / None down_since = unknown.
+IP_TO_I = {}
+HOSTNAMES = []
+IPS = []
+IS_UP = bytearray()
+TCP_OK = bytearray()
+LAST_CHANGE = []
+LATENCY = array("d")
+ALERT_SENT = bytearray()
+DOWN_SINCE = []
+last_updated = "Never"  # end of the latest monitor cycle, preformatted
 
-# Track host states
-status_data = {}
-alert_sent = {}
+# Tuple of per-host dicts, DOWN hosts first. The monitor builds a new one
+# each cycle and rebinds the name, which is atomic, so routes read it
+# without locking; nothing may mutate a snapshot once published.
+SNAPSHOT = ()
+
+# Rendered responses by route, as (created_at, body); cleared every cycle
+response_cache = {}
+
+# One keep-alive session per process, owned by the monitor's event loop;
+# reusing it skips DNS, TCP and TLS setup on every alert after the first
+SESSION = None
+alert_queue = asyncio.Queue()
+alert_flush_now = asyncio.Event()
+PROBE_SEM = asyncio.Semaphore(PROBE_LIMIT)
 
 app = Flask(__name__)
 
-def ping_host(ip):
+def parse_targets():
+    targets = []
+    with open(TARGETS_FILE) as f:
+        for line in f:
+            h, sep, ip = line.partition(",")
+            if sep:
+                targets.append((h.strip(), ip.strip()))
+    return tuple(targets)
+
+# Parsed once at import; load_targets() only re-reads ips.txt if it changed
+TARGETS = parse_targets()
+targets_mtime = os.path.getmtime(TARGETS_FILE)
+
+def load_targets():
+    global TARGETS, targets_mtime
+    mtime = os.path.getmtime(TARGETS_FILE)
+    if mtime != targets_mtime:
+        TARGETS, targets_mtime = parse_targets(), mtime
+    return TARGETS
+
+def is_ip(value):
     try:
-        result = subprocess.run(
-            ["ping", PING_PARAM, str(PING_COUNT), ip],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        return result.returncode == 0
-    except Exception:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
         return False
 
-def tcp_check(ip, port):
+def ip_family(ip):
+    return socket.AF_INET6 if ":" in ip else socket.AF_INET
+
+def open_icmp_socket(family):
+    # Raw needs CAP_NET_RAW; Linux also allows unprivileged datagram ICMP
+    proto = ICMP_FAMILIES[family][0]
+    for kind in (socket.SOCK_RAW, socket.SOCK_DGRAM):
+        try:
+            sock = socket.socket(family, kind, proto)
+        except OSError:
+            continue
+        sock.setblocking(False)
+        return sock
+    return None
+
+# One socket per address family carries every echo request for the life
+# of the process; a missing family falls back to fping/ping
+ICMP_SOCKS = {}
+for family in ICMP_FAMILIES:
+    sock = open_icmp_socket(family)
+    if sock:
+        ICMP_SOCKS[family] = sock
+
+# Each target keeps the same ident for the life of the process
+ICMP_IDENT_BASE = os.getpid() & 0xFFFF
+icmp_idents = {}
+ident_to_ip = {}
+icmp_addrs = {}  # canonical address as reported by recvfrom -> target ip
+icmp_seq = 0
+
+def icmp_ident(ip):
+    ident = icmp_idents.get(ip)
+    if ident is None:
+        ident = (ICMP_IDENT_BASE + len(icmp_idents)) & 0xFFFF
+        icmp_idents[ip] = ident
+        ident_to_ip[ident] = ip
+        icmp_addrs[str(ipaddress.ip_address(ip))] = ip
+    return ident
+
+def icmp_checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def icmp_packet(family, ident, seq):
+    echo_request = ICMP_FAMILIES[family][1]
+    payload = b"web-ping-monitor"
+    header = struct.pack("!BBHHH", echo_request, 0, 0, ident, seq)
+    if family == socket.AF_INET6:
+        # The kernel fills in the ICMPv6 checksum
+        return header + payload
+    checksum = icmp_checksum(header + payload)
+    return struct.pack("!BBHHH", echo_request, 0, checksum, ident, seq) + payload
+
+async def icmp_ping_all(ips):
+    global icmp_seq
+    icmp_seq = seq = (icmp_seq + 1) & 0xFFFF
+    loop = asyncio.get_running_loop()
+
+    results = {ip: (False, None) for ip in ips}
+    waiting = set(ips)
+    sent = {}
+    done = loop.create_future()
+
+    def on_readable(family, sock):
+        # The kernel rewrites the ident on datagram sockets, so there
+        # replies are matched on their source address instead
+        raw = sock.type == socket.SOCK_RAW
+        echo_reply = ICMP_FAMILIES[family][2]
+        while True:
+            try:
+                data, addr = sock.recvfrom(1024)
+            except OSError:
+                break
+            received = time.monotonic()
+            # Raw IPv4 sockets deliver the IP header as well
+            offset = (data[0] & 0x0F) * 4 if raw and family == socket.AF_INET else 0
+            if len(data) < offset + 8:
+                continue
+            icmp_type, _, _, ident, reply_seq = struct.unpack_from("!BBHHH", data, offset)
+            if icmp_type != echo_reply or reply_seq != seq:
+                continue
+            ip = icmp_addrs.get(addr[0])
+            if raw and ident_to_ip.get(ident) != ip:
+                continue
+            if ip not in waiting or ip not in sent:
+                continue
+            results[ip] = (True, round((received - sent[ip]) * 1000, 3))
+            waiting.discard(ip)
+        if not waiting and not done.done():
+            done.set_result(None)
+
+    # Replies are drained while later requests are still being sent
+    for family, sock in ICMP_SOCKS.items():
+        loop.add_reader(sock.fileno(), on_readable, family, sock)
+    try:
+        for ip in ips:
+            family = ip_family(ip)
+            packet = icmp_packet(family, icmp_ident(ip), seq)
+            sent[ip] = time.monotonic()
+            try:
+                await loop.sock_sendto(ICMP_SOCKS[family], packet, (ip, 0))
+            except OSError:
+                waiting.discard(ip)
+        if waiting:
+            await asyncio.wait_for(done, timeout=ICMP_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for sock in ICMP_SOCKS.values():
+            loop.remove_reader(sock.fileno())
+    return results
+
+def parse_ping_time(line):
+    # "time=12.3 ms" on Unix, "time=12ms" / "time<1ms" on Windows
+    _, sep, rest = line.partition("time")
+    if not sep or rest[:1] not in ("=", "<") or not rest[1:].split():
+        return None
     try:
-        with socket.create_connection((ip, port), timeout=3):
-            return True
+        return float(rest[1:].split()[0].rstrip("ms"))
+    except ValueError:
+        return None
+
+async def ping_one(ip):
+    # Stream ping's output and stop at the first reply instead of waiting
+    # for it to finish and buffering everything it printed
+    try:
+        async with PROBE_SEM:
+            proc = await asyncio.create_subprocess_exec(
+                "ping", *PING_ARGS, ip,
+                stdout=PIPE,
+                stderr=DEVNULL
+            )
+            try:
+                async for line in proc.stdout:
+                    latency = parse_ping_time(line.decode(errors="replace"))
+                    if latency is not None:
+                        return True, latency
+                return False, None
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
     except Exception:
-        return False
+        return False, None
+
+async def ping_all(ips):
+    # Hosts whose family has an ICMP socket use it; the rest get one fping
+    # run, or ping per host when fping is not installed
+    icmp_ips = [ip for ip in ips if ip_family(ip) in ICMP_SOCKS]
+    other_ips = [ip for ip in ips if ip_family(ip) not in ICMP_SOCKS]
+    results = {}
+    for part in await asyncio.gather(icmp_ping_all(icmp_ips), command_ping_all(other_ips)):
+        results.update(part)
+    return results
+
+async def command_ping_all(ips):
+    if FPING:
+        return await fping_all(ips)
+
+    tasks = []
+    for ip in ips:
+        tasks.append(asyncio.create_task(ping_one(ip)))
+        await asyncio.sleep(PROBE_STAGGER)
+    return dict(zip(ips, await asyncio.gather(*tasks)))
+
+async def fping_all(ips):
+    results = {ip: (False, None) for ip in ips}
+    if not ips:
+        return results
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FPING, "-C", "1", "-q", "-t", "1000", "-B", "1", "-r", "1", *ips,
+            stdout=DEVNULL,
+            stderr=PIPE
+        )
+        _, stderr = await proc.communicate()
+    except Exception:
+        return results
+
+    # fping -C -q reports "ip : 12.34" per host on stderr, "ip : -" when lost
+    for line in stderr.decode(errors="replace").splitlines():
+        ip, sep, rtt = line.partition(" : ")
+        ip, rtt = ip.strip(), rtt.strip()
+        if not sep or ip not in results or rtt == "-":
+            continue
+        try:
+            results[ip] = (True, float(rtt))
+        except ValueError:
+            pass
+    return results
+
+async def tcp_check_all(checks):
+    # Start every connect without blocking and let the event loop wait on
+    # all of them at once; writable with no SO_ERROR means the port is open
+    loop = asyncio.get_running_loop()
+    results = [False] * len(checks)
+    socks = []
+    pending = set()
+    done = loop.create_future()
+
+    def on_writable(i, sock):
+        loop.remove_writer(sock.fileno())
+        results[i] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+        pending.discard(i)
+        if not pending and not done.done():
+            done.set_result(None)
+
+    for i, (ip, port) in enumerate(checks):
+        try:
+            sock = socket.socket(ip_family(ip), socket.SOCK_STREAM)
+        except OSError:
+            continue
+        socks.append(sock)
+        sock.setblocking(False)
+        try:
+            err = sock.connect_ex((ip, port))
+        except OSError:
+            continue
+        if err == 0:
+            results[i] = True
+        elif err in CONNECT_IN_PROGRESS:
+            pending.add(i)
+            loop.add_writer(sock.fileno(), on_writable, i, sock)
+
+    try:
+        if pending:
+            await asyncio.wait_for(done, timeout=TCP_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for sock in socks:
+            loop.remove_writer(sock.fileno())
+            sock.close()
+    return results
 
 def send_webhook(message):
+    # Alerts are coalesced and posted by alert_flusher(); DOWN alerts and
+    # backed-up queues are flushed straight away
+    alert_queue.put_nowait(message)
+    if message.startswith("🚨") or alert_queue.qsize() > ALERT_FLUSH_DEPTH:
+        alert_flush_now.set()
+
+async def alert_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(alert_flush_now.wait(), timeout=ALERT_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        alert_flush_now.clear()
+        while not alert_queue.empty():
+            batch = []
+            while len(batch) < ALERT_BATCH_MAX and not alert_queue.empty():
+                batch.append(alert_queue.get_nowait())
+            await post_webhook("\n".join(batch))
+
+async def post_webhook(message):
     if not WEBHOOK_URL:
         print("[WARN] No WEBHOOK_URL set")
         return
-    try:
-        payload = {"text": message}
-        resp = requests.post(WEBHOOK_URL, json=payload)
-        if resp.status_code in (200, 201, 202, 204):
-            print("✅ Alert sent")
-        else:
-            print(f"❌ Webhook failed: {resp.status_code}")
-    except Exception as e:
-        print(f"[ERROR] {e}")
-
-def monitor():
-    # Load targets from ips.txt
-    with open("ips.txt") as f:
-        targets = []
-        for line in f:
-            if line.strip() and "," in line:
-                h, ip = line.strip().split(",", 1)
-                targets.append((h.strip(), ip.strip()))
+    payload = {"text": message}
+    for attempt in range(WEBHOOK_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(WEBHOOK_BACKOFF * 2 ** (attempt - 1))
+        try:
+            async with SESSION.post(WEBHOOK_URL, json=payload) as resp:
+                if resp.status in (200, 201, 202, 204):
+                    print("✅ Alert sent")
+                    return
+                if resp.status not in WEBHOOK_RETRY_STATUS or attempt == WEBHOOK_RETRIES:
+                    print(f"❌ Webhook failed: {resp.status}")
+                    return
+        except Exception as e:
+            if attempt == WEBHOOK_RETRIES:
+                print(f"[ERROR] {e}")
 
-    # Initialize state
-    for h, ip in targets:
-        status_data[ip] = {"hostname": h, "is_up": True, "last_change": "Never", "tcp_ok": True}
-        alert_sent[ip] = False
+def new_session():
+    connector = aiohttp.TCPConnector(limit=8, limit_per_host=8, keepalive_timeout=60, use_dns_cache=True, ttl_dns_cache=DNS_CACHE_TTL)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=WEBHOOK_TIMEOUT))
 
-    tcp_ports = [int(p.strip()) for p in TCP_PORTS.split(",") if p.strip()]
+async def producer(ips, checks, results):
+    # Probe on a fixed cadence; never wait for the consumer, drop the
+    # oldest cycle instead if it falls behind
+    while True:
+        pings, tcp_results = await asyncio.gather(
+            ping_all(ips),
+            tcp_check_all(checks)
+        )
+        tcp_failed = {ip for (ip, _), ok in zip(checks, tcp_results) if not ok}
+        if results.full():
+            results.get_nowait()
+        results.put_nowait((time.time(), pings, tcp_failed))
+        await asyncio.sleep(1)  # tiny delay to prevent CPU overuse
+
+async def consumer(results):
+    global SNAPSHOT, last_updated
+
+    # Locals are cheaper than globals in the per-host loop
+    hostnames, ips, is_up_at, tcp_ok_at = HOSTNAMES, IPS, IS_UP, TCP_OK
+    last_change, latency_at, sent, since = LAST_CHANGE, LATENCY, ALERT_SENT, DOWN_SINCE
+    alert = send_webhook
+    nan = float("nan")
 
     while True:
-        for h, ip in targets:
-            ping_ok = ping_host(ip)
-            tcp_ok = all(tcp_check(ip, port) for port in tcp_ports) if tcp_ports else True
+        now, pings, tcp_failed = await results.get()
+        # Formatted once per cycle and shared by every host and route
+        now_str = f"{datetime.fromtimestamp(now, timezone.utc):%Y-%m-%d %H:%M:%S} UTC"
+        for i, ip in enumerate(ips):
+            ping_ok, latency = pings.get(ip, (False, None))
+            tcp_ok = ip not in tcp_failed
             is_up = ping_ok and tcp_ok
-            prev = status_data[ip]["is_up"]
+            prev = is_up_at[i]
 
             # Update status
-            status_data[ip].update(is_up=is_up, last_change=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"), tcp_ok=tcp_ok)
+            is_up_at[i] = is_up
+            tcp_ok_at[i] = tcp_ok
+            last_change[i] = now_str
+            latency_at[i] = nan if latency is None else latency
 
-            # Send alerts if status changed
-            if is_up and prev is False and alert_sent[ip]:
-                send_webhook(f"✅ **RECOVERY:** {h} ({ip}) is back UP")
-                alert_sent[ip] = False
-            elif not is_up and prev is True:
-                send_webhook(f"🚨 **ALERT:** {h} ({ip}) is DOWN")
-                alert_sent[ip] = True
+            # Alert once a host has been DOWN for the grace period
+            if is_up:
+                since[i] = None
+                if not prev and sent[i]:
+                    alert(f"✅ **RECOVERY:** {hostnames[i]} ({ip}) is back UP")
+                    sent[i] = False
+            else:
+                if since[i] is None:
+                    since[i] = now
+                if not sent[i] and now - since[i] >= GRACE_PERIOD:
+                    alert(f"🚨 **ALERT:** {hostnames[i]} ({ip}) is DOWN")
+                    sent[i] = True
 
-        time.sleep(1)  # tiny delay to prevent CPU overuse
+        # DOWN hosts first, otherwise in ips.txt order
+        SNAPSHOT = tuple(
+            {
+                "hostname": hostnames[i], "ip": ips[i], "is_up": bool(is_up_at[i]), "last_change": last_change[i],
+                "tcp_ok": bool(tcp_ok_at[i]), "latency": None if math.isnan(latency_at[i]) else latency_at[i],
+            }
+            for i in sorted(range(len(ips)), key=is_up_at.__getitem__)
+        )
+        last_updated = now_str
+        response_cache.clear()
+
+def add_host(hostname, ip):
+    i = IP_TO_I.get(ip)
+    if i is not None:
+        HOSTNAMES[i] = hostname
+        return
+    IP_TO_I[ip] = len(IPS)
+    HOSTNAMES.append(hostname)
+    IPS.append(ip)
+    IS_UP.append(True)
+    TCP_OK.append(True)
+    LAST_CHANGE.append("Never")
+    LATENCY.append(float("nan"))
+    ALERT_SENT.append(False)
+    DOWN_SINCE.append(None)
+
+async def monitor():
+    global SESSION
+
+    targets = load_targets()
+
+    # Initialize state
+    for h, ip in targets:
+        add_host(h, ip)
+
+    tcp_ports = [int(p.strip()) for p in TCP_PORTS.split(",") if p.strip()]
+    # Only literal addresses are probed, so no probe ever waits on DNS;
+    # anything else (e.g. a blank entry) simply shows as DOWN
+    ips = [ip for ip in IPS if is_ip(ip)]
+    checks = [(ip, port) for ip in ips for port in tcp_ports]
+    results = asyncio.Queue(maxsize=PROBE_QUEUE_MAX)
+
+    async with new_session() as SESSION:
+        flusher = asyncio.create_task(alert_flusher())
+        await asyncio.gather(producer(ips, checks, results), consumer(results))
 
 # Start monitoring in background thread
-threading.Thread(target=monitor, daemon=True).start()
+threading.Thread(target=lambda: asyncio.run(monitor()), daemon=True).start()
+
+def cached(name, build):
+    hit = response_cache.get(name)
+    now = time.time()
+    if hit and now - hit[0] < RESPONSE_CACHE_TTL:
+        return hit[1]
+    body = build()
+    response_cache[name] = (now, body)
+    return body
 
 # Flask routes
 @app.route("/")
 def index():
-    # Sort DOWN hosts to the top
-    rows = sorted(
-        [
-            {"hostname": v["hostname"], "ip": ip, "is_up": v["is_up"], "last_change": v["last_change"], "tcp_ok": v.get("tcp_ok", True)}
-            for ip, v in status_data.items()
-        ],
-        key=lambda x: x["is_up"]
-    )
-    return render_template("index.html", status=rows, last_updated=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"), auto_refresh=AUTO_REFRESH)
+    def render():
+        return render_template("index.html", status=SNAPSHOT, last_updated=last_updated, auto_refresh=AUTO_REFRESH)
+
+    # Browsers revalidating an unchanged page get a 304
+    resp = make_response(cached("index", render))
+    resp.add_etag()
+    return resp.make_conditional(request)
 
 @app.route("/status.json")
 def status_json():
-    return jsonify(status_data)
+    def render():
+        # Keeps the {ip: {...}} shape clients already rely on
+        return orjson.dumps({row["ip"]: {k: v for k, v in row.items() if k != "ip"} for row in SNAPSHOT}, option=orjson.OPT_NON_STR_KEYS)
+
+    return Response(cached("status", render), mimetype="application/json")
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,4 @@
+# Production entry point: gunicorn wsgi:app (see Procfile).
+# Keep a single worker so there is one monitor thread and one status_data;
+# gthread gives Flask several request threads inside that worker.
+from monitor_web import app